@@ -1,7 +1,5 @@
 import streamlit as st
-from pathlib import Path
-
-from converter import convert_uploaded_file
+from concurrent.futures import ThreadPoolExecutor
 
 st.set_page_config(
     page_title="DOCX → HTML SEO Converter",
@@ -24,23 +22,29 @@ if uploaded_files:
     st.success(f"{len(uploaded_files)} file caricati")
 
     if st.button("🚀 Converti"):
+        # import al primo click: il primo render non carica python-docx
+        from converter import convert_uploaded_file
+
         with st.spinner("Conversione in corso..."):
             outputs = []
 
-            for uf in uploaded_files:
-                try:
-                    out_path = convert_uploaded_file(uf)
-                    outputs.append(out_path)
-                except Exception as e:
-                    st.error(f"Errore su {uf.name}: {e}")
+            # i file sono indipendenti: conversione in parallelo,
+            # risultati ed errori raccolti nell'ordine di upload
+            with ThreadPoolExecutor(max_workers=min(8, len(uploaded_files))) as ex:
+                futures = [(uf, ex.submit(convert_uploaded_file, uf)) for uf in uploaded_files]
+
+                for uf, fut in futures:
+                    try:
+                        outputs.append(fut.result())
+                    except Exception as e:
+                        st.error(f"Errore su {uf.name}: {e}")
 
         st.success("Conversione completata!")
 
-        for out in outputs:
-            with open(out, "rb") as f:
-                st.download_button(
-                    label=f"⬇️ Scarica {out.name}",
-                    data=f,
-                    file_name=out.name,
-                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-                )
+        for name, data in outputs:
+            st.download_button(
+                label=f"⬇️ Scarica {name}",
+                data=data,
+                file_name=name,
+                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+            )
@@ -1,16 +1,20 @@
+import io
+import posixpath
 import re
-import html
-import tempfile
+import zipfile
+from copy import deepcopy
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
-from typing import List, Dict, Any, Iterable, Union
+from typing import List, Dict, Any, Iterable, NamedTuple, Tuple, Union, IO
 
+import docx
 from docx import Document
-from docx.text.paragraph import Paragraph
-from docx.table import Table
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.oxml import OxmlElement
 from docx.oxml.ns import qn
 from docx.shared import Pt, RGBColor
+from lxml import etree
 
 
 # =========================
@@ -36,74 +40,111 @@ INPUT_KEY_MAP = {
     "h1": "H1",
 }
 
-TESTO_KEYS = {"testo", "content", "article", "body", "testo articolo"}
+TESTO_KEYS = frozenset({"testo", "content", "article", "body", "testo articolo"})
+
+_P_OPEN = '<p class="h-text-size-14 h-font-primary">'
+_P_CLOSE = "</p>"
+_H2_OPEN = "<h2><strong>"
+_H2_CLOSE = "</strong></h2>"
+
+_KEY_FIRST_CHARS = frozenset(k[0] for k in INPUT_KEY_MAP)
+
+_ANCHOR_RE = re.compile(r"<a\s+href=\"[^\"]+\">.*?</a>", re.I | re.S)
+
+_PACKAGE_RELS_PART = "_rels/.rels"
+_DOCUMENT_PART = "word/document.xml"
+_PKG_RELATIONSHIP = "{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"
+_XML_PARSER = etree.XMLParser(resolve_entities=False)
+
+_W_BODY = qn("w:body")
+_W_P = qn("w:p")
+_W_TBL = qn("w:tbl")
+_W_TR = qn("w:tr")
+_W_TC = qn("w:tc")
+_W_R = qn("w:r")
+_W_HYPERLINK = qn("w:hyperlink")
+_W_T = qn("w:t")
+_R_ID = qn("r:id")
+
+# html.escape(quote=False) + entità, in un unico passaggio
+_ENTITY_TABLE = str.maketrans({
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    "’": "&rsquo;",
+    "‘": "&lsquo;",
+    "“": "&ldquo;",
+    "”": "&rdquo;",
+    "–": "&ndash;",
+    "—": "&mdash;",
+    "…": "&hellip;",
+    "à": "&agrave;",
+    "è": "&egrave;",
+    "é": "&eacute;",
+    "ì": "&igrave;",
+    "ò": "&ograve;",
+    "ù": "&ugrave;",
+    "À": "&Agrave;",
+    "È": "&Egrave;",
+    "É": "&Eacute;",
+    "Ì": "&Igrave;",
+    "Ò": "&Ograve;",
+    "Ù": "&Ugrave;",
+})
 
 
 # =========================
 # HTML entities (SOLO OUTPUT)
 # =========================
 
+@lru_cache(maxsize=1024)
 def html_entities(s: str) -> str:
     if not s:
         return ""
 
-    anchors = []
-
-    def stash_anchor(m):
-        anchors.append(m.group(0))
-        return f"__ANCHOR_{len(anchors)-1}__"
-
-    s = re.sub(r"<a\s+href=\"[^\"]+\">.*?</a>", stash_anchor, s, flags=re.I | re.S)
-
-    s = html.escape(s, quote=False)
-
-    replacements = {
-        "’": "&rsquo;",
-        "‘": "&lsquo;",
-        "“": "&ldquo;",
-        "”": "&rdquo;",
-        "–": "&ndash;",
-        "—": "&mdash;",
-        "…": "&hellip;",
-        "à": "&agrave;",
-        "è": "&egrave;",
-        "é": "&eacute;",
-        "ì": "&igrave;",
-        "ò": "&ograve;",
-        "ù": "&ugrave;",
-        "À": "&Agrave;",
-        "È": "&Egrave;",
-        "É": "&Eacute;",
-        "Ì": "&Igrave;",
-        "Ò": "&Ograve;",
-        "Ù": "&Ugrave;",
-    }
+    if s.isascii() and "&" not in s and "<" not in s and ">" not in s:
+        return s
 
-    for k, v in replacements.items():
-        s = s.replace(k, v)
+    # niente link: basta la tabella (_ANCHOR_RE è case-insensitive)
+    if "<a" not in s and "<A" not in s:
+        return s.translate(_ENTITY_TABLE)
 
-    for i, a in enumerate(anchors):
-        s = s.replace(f"__ANCHOR_{i}__", a)
+    # i link <a href> restano intatti, il resto viene escapato
+    parts = []
+    pos = 0
+    for m in _ANCHOR_RE.finditer(s):
+        parts.append(s[pos:m.start()].translate(_ENTITY_TABLE))
+        parts.append(m.group(0))
+        pos = m.end()
+    parts.append(s[pos:].translate(_ENTITY_TABLE))
 
-    return s
+    return "".join(parts)
 
 
 # =========================
 # DOCX helpers
 # =========================
 
+_SHD_CACHE: Dict[str, Any] = {}
+
 def shade_cell(cell, fill_hex: str):
-    tc_pr = cell._tc.get_or_add_tcPr()
-    shd = OxmlElement("w:shd")
-    shd.set(qn("w:val"), "clear")
-    shd.set(qn("w:color"), "auto")
-    shd.set(qn("w:fill"), fill_hex)
-    tc_pr.append(shd)
+    # un <w:shd> per colore, poi solo deepcopy
+    shd = _SHD_CACHE.get(fill_hex)
+    if shd is None:
+        shd = OxmlElement("w:shd")
+        shd.set(qn("w:val"), "clear")
+        shd.set(qn("w:color"), "auto")
+        shd.set(qn("w:fill"), fill_hex)
+        _SHD_CACHE[fill_hex] = shd
+    cell._tc.get_or_add_tcPr().append(deepcopy(shd))
 
 def set_cell_text(cell, text: str, bold=False, color=None, size_pt=10):
-    cell.text = ""
-    p = cell.paragraphs[0]
-    r = p.add_run(text or "")
+    # cella appena creata (un solo paragrafo vuoto): niente da svuotare
+    paragraphs = cell.paragraphs
+    if len(paragraphs) != 1 or paragraphs[0].runs or cell.tables:
+        cell.text = ""
+        paragraphs = cell.paragraphs
+    r = paragraphs[0].add_run(text or "")
     r.bold = bold
     r.font.size = Pt(size_pt)
     if color:
@@ -114,16 +155,25 @@ def set_cell_text(cell, text: str, bold=False, color=None, size_pt=10):
 # Iterazione DOCX
 # =========================
 
-def iter_block_items(parent) -> Iterable[Union[Paragraph, Table]]:
-    from docx.oxml.text.paragraph import CT_P
-    from docx.oxml.table import CT_Tbl
+def iter_paragraph_elements(container) -> Iterable[Any]:
+    # stack di iteratori sugli elementi lxml: le tabelle annidate vengono
+    # visitate in ordine di documento, a qualsiasi profondità, e ogni
+    # <w:tc> una sola volta (anche se unita ad altre celle)
+    stack = [container.iterchildren(_W_P, _W_TBL)]
+    while stack:
+        elm = next(stack[-1], None)
+        if elm is None:
+            stack.pop()
+
+        elif elm.tag == _W_P:
+            yield elm
 
-    parent_elm = parent.element.body if hasattr(parent, "element") else parent._tc
-    for child in parent_elm.iterchildren():
-        if isinstance(child, CT_P):
-            yield Paragraph(child, parent)
-        elif isinstance(child, CT_Tbl):
-            yield Table(child, parent)
+        else:
+            stack.append(chain.from_iterable(
+                tc.iterchildren(_W_P, _W_TBL)
+                for tr in elm.iterchildren(_W_TR)
+                for tc in tr.iterchildren(_W_TC)
+            ))
 
 
 # =========================
@@ -131,35 +181,26 @@ def iter_block_items(parent) -> Iterable[Union[Paragraph, Table]]:
 # =========================
 
 def _iter_text_runs(node) -> str:
-    texts = []
-    for t in node.findall(".//w:t", namespaces=node.nsmap):
-        if t.text:
-            texts.append(t.text)
-    return "".join(texts)
+    return "".join(t.text for t in node.iter(_W_T) if t.text)
 
-def paragraph_to_text_with_links(paragraph: Paragraph) -> str:
+def paragraph_to_text_with_links(p, rels: Dict[str, str]) -> str:
     out = []
-    part = paragraph.part
 
-    for child in paragraph._p.iterchildren():
+    for child in p.iterchildren(_W_HYPERLINK, _W_R):
         tag = child.tag
 
         # hyperlink
-        if tag.endswith("}hyperlink"):
-            r_id = child.get(qn("r:id"))
+        if tag == _W_HYPERLINK:
+            href = rels.get(child.get(_R_ID))
             text = _iter_text_runs(child)
 
-            if r_id and r_id in part.rels and text.strip():
-                href = part.rels[r_id].target_ref
+            if href is not None and text and not text.isspace():
                 out.append(f'<a href="{href}">{text}</a>')
 
         # run normale (NON dentro hyperlink)
-        elif tag.endswith("}r"):
-            if child.getparent() is not paragraph._p:
-                continue
-
+        elif tag == _W_R:
             text = _iter_text_runs(child)
-            if text.strip():
+            if text and not text.isspace():
                 out.append(text)
 
     return "".join(out).strip()
@@ -169,70 +210,103 @@ def paragraph_to_text_with_links(paragraph: Paragraph) -> str:
 # Estrazione RAW
 # =========================
 
-def extract_lines_raw(doc: Document) -> List[str]:
-    lines = []
+def _main_document_part(z: zipfile.ZipFile) -> str:
+    # la parte principale è indicata dalla relazione officeDocument in
+    # _rels/.rels (non sempre è word/document.xml, es. word/document2.xml)
+    try:
+        pkg_rels = etree.fromstring(z.read(_PACKAGE_RELS_PART), _XML_PARSER)
+    except KeyError:
+        return _DOCUMENT_PART
+
+    for rel in pkg_rels.iter(_PKG_RELATIONSHIP):
+        if rel.get("Type", "").endswith("/officeDocument") and rel.get("Target"):
+            return posixpath.normpath(rel.get("Target").lstrip("/"))
 
-    for block in iter_block_items(doc):
-        if isinstance(block, Paragraph):
-            t = paragraph_to_text_with_links(block)
-            if t:
-                lines.append(t)
+    return _DOCUMENT_PART
 
-        elif isinstance(block, Table):
-            for row in block.rows:
-                for cell in row.cells:
-                    for p in cell.paragraphs:
-                        t = paragraph_to_text_with_links(p)
-                        if t:
-                            lines.append(t)
+def read_document_xml(src: Union[Path, IO[bytes]]) -> Tuple[Any, Dict[str, str]]:
+    # in lettura bastano la parte principale e le sue relazioni: niente
+    # python-docx, stili, numbering, ecc.
+    with zipfile.ZipFile(src) as z:
+        part = _main_document_part(z)
+        document_xml = z.read(part)
 
-    return lines
+        part_dir, part_name = posixpath.split(part)
+        try:
+            rels_xml = z.read(posixpath.join(part_dir, "_rels", part_name + ".rels"))
+        except KeyError:
+            rels_xml = None
+
+    body = etree.fromstring(document_xml, _XML_PARSER).find(_W_BODY)
+
+    # r:id -> href
+    rels = {}
+    if rels_xml is not None:
+        for rel in etree.fromstring(rels_xml, _XML_PARSER).iter(_PKG_RELATIONSHIP):
+            rels[rel.get("Id")] = rel.get("Target")
+
+    return body, rels
+
+def iter_lines_raw(src: Union[Path, IO[bytes]]) -> Iterable[str]:
+    body, rels = read_document_xml(src)
+    if body is None:
+        return
+
+    for p in iter_paragraph_elements(body):
+        t = paragraph_to_text_with_links(p, rels)
+        if t:
+            yield t
 
 
 # =========================
 # Parsing input DOCX
 # =========================
 
-def parse_input_docx(path: Path) -> Dict[str, Any]:
-    doc = Document(str(path))
-    lines = extract_lines_raw(doc)
+class BodyBlock(NamedTuple):
+    block: str
+    html: str
+
 
+def parse_input_docx(src: Union[Path, IO[bytes]]) -> Dict[str, Any]:
     meta = {k: "" for k in OUTPUT_META_LABELS}
-    body: List[Dict[str, str]] = []
+    body: List[BodyBlock] = []
     h1 = ""
+    h2_count = 0
 
     in_testo = False
-    testo_re = re.compile(r"^({})\s*:\s*$".format("|".join(TESTO_KEYS)), re.I)
 
-    for line in lines:
-        if testo_re.match(line):
+    for line in iter_lines_raw(src):
+        # marcatore "Testo:" (anche dentro il corpo viene saltato)
+        if line[-1] == ":" and line[:-1].rstrip().lower() in TESTO_KEYS:
             in_testo = True
             continue
 
         if not in_testo:
-            m = re.match(r"^([^:]{1,80})\s*:\s*(.*)$", line)
-            if m:
-                key = m.group(1).strip().lower()
-                val = m.group(2).strip()
-                if key in INPUT_KEY_MAP:
-                    out = INPUT_KEY_MAP[key]
-                    if out == "H1":
-                        h1 = val
-                    elif out in meta:
-                        meta[out] = val
+            # le righe sono già strip(): il primo carattere è quello della chiave
+            if line[:1].lower() not in _KEY_FIRST_CHARS:
+                continue
+            # "Chiave: valore" con i due punti entro l'80° carattere
+            colon = line.find(":", 0, 81)
+            if colon > 0:
+                out = INPUT_KEY_MAP.get(line[:colon].strip().lower())
+                if out == "H1":
+                    h1 = line[colon + 1:].strip()
+                elif out in meta:
+                    meta[out] = line[colon + 1:].strip()
             continue
 
-        m = re.match(r"^(.*)\s*\((h2|h3)\)\s*$", line, re.I)
-        if m:
-            body.append({
-                "block": "✏️ S3",
-                "html": f"<h2><strong>{html_entities(m.group(1))}</strong></h2>"
-            })
+        # "Titolo sezione (h2)" / "(h3)": le righe sono già strip()
+        if line[-4:].lower() in ("(h2)", "(h3)"):
+            body.append(BodyBlock(
+                "✏️ S3",
+                f"{_H2_OPEN}{html_entities(line[:-4])}{_H2_CLOSE}"
+            ))
+            h2_count += 1
         else:
-            body.append({
-                "block": "Intro" if not body else "✏️ S3",
-                "html": f'<p class="h-text-size-14 h-font-primary">{html_entities(line)}</p>'
-            })
+            body.append(BodyBlock(
+                "Intro" if not body else "✏️ S3",
+                f"{_P_OPEN}{html_entities(line)}{_P_CLOSE}"
+            ))
 
     if not h1:
         h1 = meta.get("Title") or "Untitled"
@@ -240,7 +314,8 @@ def parse_input_docx(path: Path) -> Dict[str, Any]:
     return {
         "meta": meta,
         "h1": h1,
-        "body": body
+        "body": body,
+        "h2_count": h2_count
     }
 
 
@@ -248,10 +323,9 @@ def parse_input_docx(path: Path) -> Dict[str, Any]:
 # Structure of content
 # =========================
 
-def build_structure(body: List[Dict[str, str]]) -> List[str]:
+def build_structure(parsed: Dict[str, Any]) -> List[str]:
     s = ["H1", "Intro"]
-    s3 = sum(1 for b in body if b["block"] == "✏️ S3" and b["html"].startswith("<h2"))
-    s.extend(["✏️ S3"] * s3)
+    s.extend(["✏️ S3"] * parsed["h2_count"])
     return s
 
 
@@ -259,8 +333,13 @@ def build_structure(body: List[Dict[str, str]]) -> List[str]:
 # Output DOCX
 # =========================
 
-def write_output_docx(parsed: Dict[str, Any], out: Path):
-    doc = Document()
+@lru_cache(maxsize=None)
+def _default_template() -> bytes:
+    # lo stesso default.docx che Document() rilegge da disco a ogni chiamata
+    return (Path(docx.__file__).parent / "templates" / "default.docx").read_bytes()
+
+def write_output_docx(parsed: Dict[str, Any], out: Union[Path, IO[bytes]]):
+    doc = Document(io.BytesIO(_default_template()))
     meta = parsed["meta"]
 
     p = doc.add_paragraph()
@@ -285,37 +364,32 @@ def write_output_docx(parsed: Dict[str, Any], out: Path):
 
     p = doc.add_paragraph("Structure of content:")
     p.runs[0].bold = True
-    for l in build_structure(parsed["body"]):
+    for l in build_structure(parsed):
         doc.add_paragraph(l)
 
     doc.add_paragraph("")
     doc.add_paragraph("")
 
-    t2 = doc.add_table(rows=1, cols=2)
+    body = parsed["body"]
+    t2 = doc.add_table(rows=1 + len(body), cols=2)
     t2.style = "Table Grid"
     set_cell_text(t2.cell(0, 0), "Block", bold=True)
     set_cell_text(t2.cell(0, 1), "⭐ HTML Output ⭐", bold=True)
 
-    for item in parsed["body"]:
-        row = t2.add_row().cells
-        row[0].text = item["block"]
-        row[1].add_paragraph(item["html"])
+    for row, item in zip(t2.rows[1:], body):
+        cells = row.cells
+        cells[0].text = item.block
+        cells[1].add_paragraph(item.html)
 
-    doc.save(str(out))
+    doc.save(str(out) if isinstance(out, Path) else out)
 
 
 # =========================
 # Streamlit helper
 # =========================
 
-def convert_uploaded_file(uploaded_file):
-    with tempfile.TemporaryDirectory() as d:
-        d = Path(d)
-        inp = d / uploaded_file.name
-        out = d / f"output_{uploaded_file.name}"
-        inp.write_bytes(uploaded_file.read())
-        parsed = parse_input_docx(inp)
-        write_output_docx(parsed, out)
-        final = Path(tempfile.gettempdir()) / out.name
-        final.write_bytes(out.read_bytes())
-        return final
+def convert_uploaded_file(uploaded_file) -> Tuple[str, bytes]:
+    parsed = parse_input_docx(uploaded_file)
+    buf = io.BytesIO()
+    write_output_docx(parsed, buf)
+    return f"output_{uploaded_file.name}", buf.getvalue()